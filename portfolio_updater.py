@@ -24,12 +24,29 @@ Created on 1/9/2018 by Daniil Feoktistov for Markov Processes International, Inc
 # A class for generating and editing Stylus Pro portfolios
 
 import  pandas  as pd
+import   numpy  as np
 import openpyxl as xl
 import    os
-import    re
 import    sys
 import datetime
 
+try:
+    import python_calamine
+except ImportError:
+    python_calamine = None
+try:
+    import fastxlsx
+except ImportError:
+    fastxlsx = None
+try:
+    import wolfxl
+except ImportError:
+    wolfxl = None
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
 class PortfolioUpdater:
     def load(self, filename, sheetname, path=None, stylus_formatted=False):
         """Loads an Excel worksheet in as a portfolio object.
@@ -60,31 +77,57 @@ class PortfolioUpdater:
               3+. Date (datetime.datetime object)
         """
         filename = os.path.join(path, filename) if path else filename
-        sheet = xl.load_workbook(filename)[sheetname]
         if stylus_formatted:
-            # Sheet metadata (MPI_ASSETIDRANGE, MPI_REBALANCE, etc.) is stored
-            # and passed through to the output file.
-            metadata, cellrange = self.get_metadata(sheet)
-            portfolio = self.get_portfolio(sheet, cellrange)
-            df = pd.DataFrame(portfolio)
-            # Names fields by first row and drops that row.
-            df.rename(columns = df.iloc[0], inplace=True)
-            df.drop(df.index[0], inplace=True)
-            df.set_index('ID', inplace=True)
-            return df, metadata
+            # Read-only mode streams rows from the worksheet XML instead of
+            # building the whole workbook in memory.
+            # The file handle stays open until close(), so it is closed even
+            # if the sheet fails to parse.
+            book = xl.load_workbook(filename, read_only=True, data_only=True, keep_links=False)
+            try:
+                sheet = book[sheetname]
+                # Sheet metadata (MPI_ASSETIDRANGE, MPI_REBALANCE, etc.) is
+                # stored and passed through to the output file.
+                metadata, cellrange = self.get_metadata(sheet)
+                header, portfolio = self.get_portfolio(sheet, cellrange)
+                # Fields are named on construction, so no header row needs to
+                # be renamed and dropped afterwards.
+                df = pd.DataFrame.from_records(portfolio, columns=header).set_index('ID')
+            finally:
+                book.close()
         else:
+            # Only the first two rows are needed to tell whether metadata is
+            # present, so the rest of the sheet is parsed once by read_excel.
+            if python_calamine:
+                with python_calamine.CalamineWorkbook.from_path(filename) as book:
+                    rows = book.get_sheet_by_name(sheetname).to_python(skip_empty_area=False, nrows=2)
+                # calamine reports empty cells as '', whole numbers as floats
+                # and dates as datetime.date, where openpyxl reads None, int and
+                # datetime.datetime, so they are normalized to match.
+                rows = [[self._from_calamine(value) for value in row] for row in rows]
+            else:
+                book = xl.load_workbook(filename, read_only=True, data_only=True, keep_links=False)
+                try:
+                    rows = list(book[sheetname].iter_rows(min_row=1, max_row=2, values_only=True))
+                finally:
+                    book.close()
+            # The Rust calamine reader is several times faster than openpyxl
+            # for straight DataFrame loads.
+            engine = 'calamine' if python_calamine else None
             # Case where no metadata is provided.
-            if sheet[1][0].value == 'ID':
-                df = pd.read_excel(filename, sheetname=sheetname, index_col=0)
+            if rows[0][0] == 'ID':
+                df = pd.read_excel(filename, sheet_name=sheetname, index_col=0, engine=engine)
                 metadata = None
             # Case where metadata is provided.
             else:
-                df = pd.read_excel(filename, sheetname=sheetname, skiprows=[0,1], index_col=0)
-                metadata = {}
-                for key, value in zip(sheet['1'], sheet['2']):
-                    if key.value:
-                        metadata[key.value] = value.value
-            return df, metadata
+                df = pd.read_excel(filename, sheet_name=sheetname, skiprows=[0,1], index_col=0, engine=engine)
+                metadata = {key: value for key, value in zip(rows[0], rows[1]) if key}
+        # IDs, labels and database IDs are stored as categoricals: an array of
+        # unique strings plus small integer codes, which are cheaper to hold
+        # and to hash when portfolios are merged.
+        df.index = pd.CategoricalIndex(df.index, name='ID')
+        df['Label'] = df['Label'].astype('category')
+        df['DBID'] = df['DBID'].astype('category')
+        return df, metadata
             
 
     def add_dates(self, portfolio, additions):
@@ -97,7 +140,9 @@ class PortfolioUpdater:
         The outer merge process creates rows in <portfolio> for entries in
         <additions> that are not shared. If a fund exists in one portfolio and
         not the other, its values for dates it has not been assigned weights
-        are set to zero.
+        are set to zero. Funds are matched on ID, Label and DBID together.
+        Where both portfolios hold a weight for the same fund and date, the one
+        in <portfolio> is kept.
         
         After this process, date columns are resorted in order to allow for
         insertion of weight dates in addition to apppending.
@@ -112,13 +157,37 @@ class PortfolioUpdater:
             DataFrame containing union of rows and columns from 'portfolio' and
             'additions'. Date columns are sorted
         '''
-        portfolio.reset_index(inplace=True)
-        portfolio = portfolio.merge(additions.reset_index(), how='outer')
-        portfolio.set_index('ID', inplace=True)
-        # Dates are separated out temporarily in order to sort them while
-        # retaining order of the first few columns.
-        dates_sorted = portfolio.iloc[:,2:].sort_index(axis=1)
-        return pd.concat([portfolio.iloc[:,:2], dates_sorted], axis=1)
+        # Fund fields are stored as categoricals, as load() does. Frames built
+        # elsewhere are converted here, and both portfolios are given one
+        # shared set of categories per field, so the keys below factorize
+        # straight from their codes.
+        fund_keys = ['ID', 'Label', 'DBID']
+        portfolio = portfolio.reset_index()
+        additions = additions.reset_index()
+        dtypes = {}
+        for field in fund_keys:
+            categories = pd.Categorical(portfolio[field]).categories.union(pd.Categorical(additions[field]).categories)
+            dtypes[field] = pd.CategoricalDtype(categories)
+        portfolio = portfolio.astype(dtypes).set_index(fund_keys)
+        additions = additions.astype(dtypes).set_index(fund_keys)
+        # Funds are keyed on ID, Label and DBID together, as the same ID can
+        # belong to more than one database. The keys are factorized into
+        # shared integer codes once, so the outer join hashes ints rather than
+        # tuples of strings. Values already in <portfolio> take precedence and
+        # gaps are filled in from <additions>.
+        codes, funds = pd.factorize(portfolio.index.append(additions.index), sort=True)
+        split = len(portfolio)
+        portfolio = portfolio.set_axis(codes[:split]).combine_first(additions.set_axis(codes[split:]))
+        portfolio.index = funds.take(portfolio.index).set_names(fund_keys)
+        portfolio = portfolio.reset_index().astype(dtypes).set_index('ID')
+        # Dates are sorted while retaining order of the first few columns. Only
+        # the column labels are sorted; the data is then reordered with a
+        # single positional take rather than a full sort of the frame.
+        fixed = ['Label', 'DBID']
+        fixed_cols = portfolio.columns.get_indexer(fixed)
+        date_cols = np.flatnonzero(~portfolio.columns.isin(fixed))
+        _, order = portfolio.columns[date_cols].sort_values(return_indexer=True)
+        return portfolio.iloc[:, np.concatenate([fixed_cols, date_cols[order]])]
         
     
     def write(self, portfolio, metadata, filename, sheet):
@@ -126,64 +195,226 @@ class PortfolioUpdater:
         
         The output worksheet is written the first two rows set aside for
         metadata and portfolio contents from row 5 onwards. Dates occupy row 4.
+        
+        New files are streamed out by write_new(). Existing files are patched
+        with WolfXL if available, or else opened with openpyxl, so that their
+        other sheets are kept. See write_many() to write several sheets at
+        once.
         '''
 #        metadata = self.update_metadata(portfolio, metadata, joined_metadata)
-        out_book = xl.load_workbook(filename=filename)
-        output = out_book[sheet]
-        # Metadata is written to first two rows.        
-        for col, key in enumerate(metadata.keys()):
-            output.cell(row=1, column=col+1).value = key
-            output.cell(row=2, column=col+1).value = metadata[key]
-        # Dates from header row are reformatted from datetime and written.
-        for col, header in enumerate(portfolio.axes[1]):
-            if type(header) is datetime.datetime:
-                output.cell(row=4, column=col+2).value = header.date()
-        # Body of portfolio data is parsed from DataFrame and written.
-        for row, asset in enumerate(zip(portfolio.iterrows())):
-            for id, data in asset:
-                output.cell(row=row+5, column=1).value = id
-                for col, point in enumerate(data):
-                    output.cell(row=row+5, column=col+2).value = point
+        self.write_many({sheet: (portfolio, metadata)}, filename)
+    
+    def write_many(self, sheets, filename):
+        '''Writes several Advanced Portfolios to sheets of one Excel file.
+        
+        The file is opened and saved once, however many sheets are written,
+        rather than taking a full load/save round-trip per sheet.
+        
+        Args:
+            sheets: Dictionary mapping each output sheet name to a
+                (portfolio, metadata) tuple.
+            filename: Target file name. Sheets must exist if the file does.
+        '''
+        if not os.path.exists(filename):
+            self.write_new(sheets, filename)
+            return
+        if wolfxl:
+            out_book = wolfxl.load_workbook(filename, modify=True)
+            for sheet, (portfolio, metadata) in sheets.items():
+                self._patch_sheet(out_book, portfolio, metadata, sheet)
+        else:
+            out_book = xl.load_workbook(filename=filename)
+            for sheet, (portfolio, metadata) in sheets.items():
+                self._write_sheet(out_book, portfolio, metadata, sheet)
         out_book.save(filename)
+    
+    def _write_sheet(self, workbook, portfolio, metadata, sheet):
+        '''Writes an Advanced Portfolio into a sheet of a loaded openpyxl
+        workbook.'''
+        output = workbook[sheet]
+        # Metadata is written to first two rows. Passing value= sets each cell
+        # as it is created instead of assigning to it in a second step.
+        for col, (key, value) in enumerate(metadata.items(), start=1):
+            output.cell(row=1, column=col, value=key)
+            output.cell(row=2, column=col, value=value)
+        # Dates from header row are reformatted from datetime and written.
+        # Non-date fields are None, which leaves their cells untouched.
+        for col, date in enumerate(self.get_dates(portfolio), start=2):
+            output.cell(row=4, column=col, value=date)
+        # Body of portfolio data is flattened to plain tuples with the ID
+        # first, which avoids building a Series per row as iterrows() does.
+        rows = portfolio.reset_index().itertuples(index=False, name=None)
+        for row, asset in enumerate(rows, start=5):
+            for col, point in enumerate(asset, start=1):
+                output.cell(row=row, column=col).value = point
+    
+    def _patch_sheet(self, workbook, portfolio, metadata, sheet):
+        '''Writes an Advanced Portfolio into a sheet of a WolfXL workbook
+        opened in modify mode.
+        
+        Modify mode patches changed cells into the existing archive instead of
+        re-serializing the whole workbook. The metadata rows and the body are
+        each buffered with write_rows(), which WolfXL flushes in one call on
+        save rather than once per cell.
+        '''
+        output = workbook[sheet]
+        # Metadata is written to first two rows.
+        self._patch_rows(output, [list(metadata.keys()), list(metadata.values())], 1)
+        # WolfXL cannot patch date cells, so dates are written as Excel serial
+        # numbers and given a date format.
+        for col, date in enumerate(self.get_dates(portfolio), start=2):
+            if date:
+                cell = output.cell(row=4, column=col)
+                cell.value = xl.utils.datetime.to_excel(date)
+                cell.number_format = 'yyyy-mm-dd'
+        # NaN would be written out as invalid XML, so missing weights are
+        # cleared instead.
+        body = portfolio.astype(object).where(portfolio.notna(), None)
+        self._patch_rows(output, body.reset_index().values.tolist(), 5)
+    
+    def _patch_rows(self, output, rows, start_row):
+        '''Buffers rows of values into a WolfXL sheet from column A.
         
+        WolfXL cannot patch date cells, so dates are replaced with Excel serial
+        numbers and given a date format. write_rows() skips None rather than
+        clearing the cell, so blank values are cleared individually afterwards,
+        as assigning None in openpyxl does.
+        '''
+        blanks, dates = [], []
+        for row, values in enumerate(rows, start=start_row):
+            for col, value in enumerate(values, start=1):
+                if value is None:
+                    blanks.append((row, col))
+                elif isinstance(value, datetime.date):
+                    values[col-1] = xl.utils.datetime.to_excel(value)
+                    dates.append((row, col))
+        output.write_rows(rows, start_row=start_row, start_col=1, copy=False)
+        for row, col in blanks:
+            output.cell(row=row, column=col).value = None
+        for row, col in dates:
+            output.cell(row=row, column=col).number_format = 'yyyy-mm-dd'
+    
+    def write_new(self, sheets, filename):
+        '''Writes Advanced Portfolios to sheets of a new file.
+        
+        fastxlsx (Rust) writes each body as a single matrix. Otherwise
+        xlsxwriter is used in constant-memory mode, or openpyxl in write-only
+        mode if neither is installed. Both flush each row to disk once it is
+        complete, so rows are written strictly from top to bottom.
+        '''
+        if fastxlsx:
+            out_book = fastxlsx.WriteOnlyWorkbook()
+        elif xlsxwriter:
+            out_book = xlsxwriter.Workbook(filename, {'constant_memory': True, 'strings_to_numbers': False})
+        else:
+            out_book = xl.Workbook(write_only=True)
+        for sheet, (portfolio, metadata) in sheets.items():
+            self._stream_sheet(out_book, portfolio, metadata, sheet)
+        # xlsxwriter is given the filename up front and writes it on close.
+        if fastxlsx or not xlsxwriter:
+            out_book.save(filename)
+        else:
+            out_book.close()
+    
+    def _stream_sheet(self, workbook, portfolio, metadata, sheet):
+        '''Writes an Advanced Portfolio to a new sheet of a workbook created
+        by write_new().'''
+        keys = list(metadata.keys())
+        values = [metadata[key] for key in keys]
+        headers = self.get_dates(portfolio)
+        # fastxlsx and xlsxwriter do not leave NaN blank, so missing weights
+        # are cleared beforehand as openpyxl does.
+        body = portfolio.astype(object).where(portfolio.notna(), None)
+        if fastxlsx:
+            output = workbook.create_sheet(sheet)
+            output.write_row((0, 0), keys)
+            output.write_row((1, 0), values)
+            output.write_row((3, 1), headers)
+            output.write_matrix((4, 0), body.reset_index().to_numpy())
+        elif xlsxwriter:
+            output = workbook.add_worksheet(sheet)
+            date_format = workbook.add_format({'num_format': 'yyyy-mm-dd'})
+            # Metadata is written to first two rows.
+            output.write_row(0, 0, keys)
+            # Only date values take the date format, so numbers stay numbers.
+            for col, value in enumerate(values):
+                output.write(1, col, value, date_format if isinstance(value, datetime.date) else None)
+            # Dates from header row are reformatted from datetime and written.
+            output.write_row(3, 1, headers, date_format)
+            for row, asset in enumerate(body.itertuples(index=True, name=None), start=4):
+                output.write_row(row, 0, asset)
+        else:
+            # Write-only worksheets can only be appended to, so row 3 is
+            # written out blank to keep the Stylus layout.
+            output = workbook.create_sheet(sheet)
+            output.append(keys)
+            output.append(values)
+            output.append([])
+            output.append([None] + headers)
+            for asset in body.itertuples(index=True, name=None):
+                output.append(asset)
+        
+    def _from_calamine(self, value):
+        '''Converts a cell value read by calamine to the value openpyxl reads
+        from the same cell.
+        '''
+        if value == '':
+            return None
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+            return datetime.datetime.combine(value, datetime.time())
+        return value
+    
     def get_metadata(self, sheet):
         '''Retrieves portfolio metadata from a Stylus-formatted sheet.
         
         Returns a dictionary containing metadata and a string representing
         the cell range of portfolio data in the worksheet.
         '''
-        metadata = {}
         # Rows 1 and 2 contain metadata parameter and value, respectively
-        for key, value in zip(sheet['1'], sheet['2']):
-            if key.value:
-                metadata[key.value] = value.value
+        keys, values = sheet.iter_rows(min_row=1, max_row=2, values_only=True)
+        metadata = {key: value for key, value in zip(keys, values) if key}
         # The range of cells to be red is determined from the row range of
         # MPI_LABELRANGE and the column range of MPI_PORTFOLIODATERANGE.
         rowrange = metadata['MPI_LABELRANGE'].split(":")
         colrange = metadata['MPI_PORTFOLIODATERANGE'].split(":")
         cellrange = ['','']
         cellrange[0] = 'A'+str(int(rowrange[0][1:])-1)
-        # A regex is used to to isolate the row number from the cell identifier.
-        cellrange[1] = re.split('(\d+)',colrange[1])[0]+rowrange[1][1:]
+        # Trailing digits are stripped to isolate the column letters from the
+        # cell identifier.
+        cellrange[1] = colrange[1].rstrip('0123456789')+rowrange[1][1:]
         # The remaining range is parsed into a list-of-lists, which is then
         # passed into a pandas DataFrame.
         return metadata, cellrange
     
     def get_portfolio(self, sheet, cellrange):
-        '''Returns a nested list representing portfolio data fom a Stylus-
-        formatted Excel worksheet.'''
-        portfolio = []
-        rows = sheet[cellrange[0]:cellrange[1]]
+        '''Returns the header row and an iterator over rows of portfolio data
+        fom a Stylus-formatted Excel worksheet.
+        
+        Rows are yielded as tuples of raw values while the worksheet is read,
+        so the iterator must be consumed before the workbook is closed.
+        '''
+        # Read-only worksheets cannot be sliced by cell address, so the range
+        # is converted to integer bounds and streamed row by row.
+        min_col, min_row, max_col, max_row = xl.utils.range_boundaries(':'.join(cellrange))
+        rows = sheet.iter_rows(min_row=min_row, max_row=max_row,
+                               min_col=min_col, max_col=max_col, values_only=True)
         # Header row is loaded in and updated to include field names that are
         # not included in the worksheet.
-        header_row = [cell.value for cell in rows[0]]
-        header_row[:3] = ['ID', 'Label', 'DBID']
-        portfolio.append(header_row)     
+        header_row = ('ID', 'Label', 'DBID') + next(rows)[3:]
         # Remaining data can then be loaded in without adjustment.
-        for row in rows[1:]:
-            values = [cell.value for cell in row]
-            portfolio.append(values)
-        return portfolio
+        return header_row, rows
+    
+    def get_dates(self, portfolio):
+        '''Returns the date row of a portfolio as a list of datetime.date
+        objects, with None in place of non-date fields such as Label and DBID.
+        
+        The type check and conversion run as one ufunc over the column index.
+        '''
+        headers = np.asarray(portfolio.columns.values, dtype=object)
+        to_date = np.frompyfunc(lambda header: header.date() if isinstance(header, datetime.datetime) else None, 1, 1)
+        return to_date(headers).tolist()
     
     def update_metadata(self, portfolio, metadata, joined_metadata=None):
         '''Updates existing metadata to reflect a portfolio's new cell ranges
@@ -196,8 +427,9 @@ class PortfolioUpdater:
             metadata['MPI_Rebalance'] = 'Monthly'
         metadata['MPI_PORTFOLIOTYPE'] = 'Advanced'
         # Existing metadata is overwritten in order to accomodate for added rows or columns.
-        last_row = len(portfolio) + 4
-        last_col = xl.utils.get_column_letter(len(portfolio.axes[1])+1)
+        n_rows, n_cols = portfolio.shape
+        last_row = n_rows + 4
+        last_col = xl.utils.get_column_letter(n_cols+1)
         metadata['MPI_ASSETIDRANGE'] = 'A5:A'+str(last_row)
         metadata['MPI_LABELRANGE'] = 'B5:B'+str(last_row)
         metadata['MPI_ASSETDBIDRANGE'] = 'C5:C'+str(last_row)